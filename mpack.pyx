@@ -3,16 +3,84 @@ from future.utils import bytes_to_native_str
 
 from libc.string cimport memcpy
 from libc.stdlib cimport abort
+from cpython.buffer cimport PyObject_GetBuffer, PyBuffer_Release, PyBUF_SIMPLE
 from cpython.mem cimport PyMem_Malloc, PyMem_Realloc, PyMem_Free
 from cpython cimport array, bool, PY_MAJOR_VERSION, PY_MINOR_VERSION
 
 from cmpack cimport *
 
+from collections import OrderedDict
+from datetime import datetime, timedelta, tzinfo
 import array
+import io
+import itertools
+import socket
 import sys
+import threading
+import traceback
 
+try:
+    import queue
+except ImportError:
+    import Queue as queue
 
-__all__ = ('Packer', 'Unpacker', 'Session', 'pack', 'unpack')
+try:
+    import selectors
+except ImportError:
+    selectors = None
+
+try:
+    from datetime import timezone
+    UTC = timezone.utc
+except ImportError:
+    class _UTC(tzinfo):
+        def utcoffset(self, dt):
+            return timedelta(0)
+
+        def dst(self, dt):
+            return timedelta(0)
+
+        def tzname(self, dt):
+            return 'UTC'
+
+    UTC = _UTC()
+
+
+__all__ = ('Packer', 'Unpacker', 'Session', 'Client', 'pack', 'unpack')
+
+
+cdef size_t UNLIMITED = <size_t>-1
+DEFAULT_BUFFER_SIZE = 64 * 1024
+# messages initiated by the peer that a Connection queues for its handlers
+DEFAULT_MAX_QUEUED = 1024
+# buffers handed to a single sendmsg call(the usual IOV_MAX)
+SENDMSG_MAX_BUFFERS = 1024
+cdef array.array BYTE_ARRAY = array.array(bytes_to_native_str(b'b'))
+
+# largest str/bytes kept in the Packer cache, and largest cached tuple
+cdef size_t CACHE_MAX_LEN = 512
+cdef size_t CACHE_MAX_TUPLE_LEN = 16
+# types of the scalars that may appear in cached tuples. floats are left out
+# because 0.0 == -0.0 while their encodings differ
+CACHE_SCALARS = frozenset([type(None), bool, int, long, unicode, bytes])
+
+EPOCH = datetime(1970, 1, 1, tzinfo=UTC)
+# msgpack Timestamp extension type(-1 as read by libmpack)
+cdef int TIMESTAMP_EXT = -1
+cdef int TIMESTAMP_EXT_READ = 0xff
+
+cdef enum:
+    TIMESTAMP_EXT_HANDLER
+    TIMESTAMP_DATETIME
+    TIMESTAMP_TUPLE
+    TIMESTAMP_INT
+
+TIMESTAMP_MODES = {
+    False: TIMESTAMP_EXT_HANDLER,
+    'datetime': TIMESTAMP_DATETIME,
+    'tuple': TIMESTAMP_TUPLE,
+    'int': TIMESTAMP_INT,
+}
 
 
 def tobytes(array):
@@ -21,6 +89,34 @@ def tobytes(array):
     return array.tostring()
 
 
+def get_writer(fileobj):
+    if isinstance(fileobj, io.RawIOBase):
+        # unbuffered files may write less than they are given
+        return write_all(fileobj.write)
+    write = getattr(fileobj, 'write', None) or getattr(fileobj, 'sendall',
+                                                       None)
+    if write:
+        return write
+    send = getattr(fileobj, 'send', None)
+    if not send:
+        raise TypeError('fileobj must have a write, sendall or send method')
+    return write_all(send)
+
+
+def write_all(write):
+    """Wrap `write`, which returns the number of bytes it wrote, into a
+    function that writes all of its argument.
+    """
+    def writeall(data):
+        data = memoryview(data)
+        while data:
+            n = write(data)
+            if n is None:
+                raise MpackException('fileobj is non-blocking and not ready')
+            data = data[n:]
+    return writeall
+
+
 cdef extern from "mpack-src/src/mpack.c":
 
     void MPACK_THROW(mpack_parser_t *parser)
@@ -52,6 +148,34 @@ class MpackUserException(MpackException):
         self.exc = exc
 
 
+class MpackLimitException(MpackException):
+    def __init__(self, what, value, limit, maximum):
+        msg = '{0} of {1} exceeds {2}={3}'.format(what, value, limit, maximum)
+        super(MpackLimitException, self).__init__(msg)
+        self.limit = limit
+
+
+class MpackRemoteException(MpackException):
+    def __init__(self, error):
+        msg = 'Remote error: {0}'.format(repr(error))
+        super(MpackRemoteException, self).__init__(msg)
+        self.error = error
+
+
+class MpackConnectionException(MpackException):
+    pass
+
+
+class MpackTimeoutException(MpackException):
+    pass
+
+
+cdef size_t to_limit(object value) except? 0:
+    if value is None:
+        return UNLIMITED
+    return value
+
+
 cdef class Ref:
     cdef public object obj
     cdef public int count
@@ -131,6 +255,14 @@ cdef class Parser(Registry):
         if self.parser:
             PyMem_Free(self.parser)
 
+    cdef void reset(self):
+        """Discard the state left by an interrupted (un)parse."""
+        mpack_parser_init(self.parser, self.parser.capacity)
+        self.parser.data.p = <void*>self
+        self.registry.clear()
+        self.exception = None
+        self.root = None
+
     cdef int grow_parser(self) except -100:
         cdef mpack_uint32_t new_capacity = self.parser.capacity * 2
         cdef mpack_parser_t* new_parser = <mpack_parser_t*>PyMem_Malloc(
@@ -145,10 +277,42 @@ cdef class Parser(Registry):
 
 cdef class Packer(Parser):
     """Encapsulate options/state for serializing python objects to msgpack.
+
+    Timezone-aware `datetime` objects are packed as msgpack Timestamps(ext type
+    -1) when `timestamp` is true and passed to `ext` when it is false. The
+    default, `None`, leaves them to `ext` if it is a callable or a dict with an
+    entry for `datetime`(or a subclass), so that explicitly registered
+    handlers keep working.
+
+    When `cache_size` is positive, the encodings of up to that many `str`,
+    `bytes` and small tuples of `None`/`bool`/`int`/`str`/`bytes` values are
+    kept in a LRU cache and copied verbatim to the output when the same value
+    is packed again. Objects passed to `cache_object` are cached by identity
+    and never evicted.
     """
     cdef object ext
-
-    def __init__(self, ext=None):
+    cdef bint timestamp
+    cdef object cache
+    cdef size_t cache_size
+    cdef dict pinned
+    cdef Packer encoder
+    # the cached encoding being written, a chunk is a leaf so there's only one
+    cdef bytes chunk
+    cdef readonly unsigned long long cache_hits
+    cdef readonly unsigned long long cache_misses
+    # output state while dumping to a file
+    cdef object write
+    cdef array.array out_buf
+    cdef char* out_start
+    cdef char** out_b
+    cdef size_t* out_bl
+    cdef size_t out_size
+
+    def __init__(self, ext=None, timestamp=None, size_t cache_size=0):
+        if timestamp is None:
+            timestamp = not (callable(ext) or isinstance(ext, dict) and any(
+                isinstance(t, type) and issubclass(t, datetime) for t in ext))
+        self.timestamp = timestamp
         if callable(ext):
             self.ext = ext
         elif isinstance(ext, dict):
@@ -160,6 +324,30 @@ cdef class Packer(Parser):
             self.ext = extfn
         else:
             self.ext = None
+        self.cache = OrderedDict() if cache_size else None
+        self.cache_size = cache_size
+        self.pinned = {}
+        self.encoder = None
+        self.cache_hits = 0
+        self.cache_misses = 0
+
+    def cache_object(self, object obj):
+        """Encode `obj` once and reuse the encoding whenever it is packed.
+
+        The object is matched by identity, so it must not be modified while it
+        is cached.
+        """
+        self.pinned[id(obj)] = (obj, self.encode(obj))
+
+    def uncache_object(self, object obj):
+        self.pinned.pop(id(obj), None)
+
+    def clear_cache(self):
+        if self.cache is not None:
+            self.cache.clear()
+        self.pinned.clear()
+        self.cache_hits = 0
+        self.cache_misses = 0
 
     def __call__(self, object obj):
         if self.exception:
@@ -171,6 +359,32 @@ cdef class Packer(Parser):
         cdef size_t pos = self.pack(obj, buf, 0)
         return tobytes(buf)[:pos]
 
+    def dump(self, object obj, fileobj,
+             size_t buffer_size=DEFAULT_BUFFER_SIZE):
+        """Serialize `obj` to `fileobj`, which must have a write, sendall or
+        send method. Partial writes are retried for sockets(send) and
+        unbuffered files(`io.RawIOBase`), while other write methods must
+        write everything they are given, as buffered files do.
+
+        The output is written whenever `buffer_size` bytes are ready, and
+        str/bin/ext payloads of at least half that size are written directly
+        without being copied to the buffer.
+        """
+        self.dump_many((obj,), fileobj, buffer_size)
+
+    def dump_many(self, objs, fileobj,
+                  size_t buffer_size=DEFAULT_BUFFER_SIZE):
+        """Serialize each object of the `objs` iterable to `fileobj`, like
+        `dump`.
+        """
+        if self.exception:
+            raise MpackException(
+                "Packer instance has thrown an exception and is invalid."
+            )
+        if not buffer_size:
+            raise ValueError('buffer_size must be positive')
+        self.stream(objs, get_writer(fileobj), buffer_size)
+
     cdef long pack(self, object obj, array.array[char] buf,
                    size_t pos) except -100:
         if self.working:
@@ -209,13 +423,189 @@ cdef class Packer(Parser):
         assert len(self.registry) == 0
         return pos
 
+    cdef int stream(self, object objs, object write,
+                    size_t buffer_size) except -100:
+        if self.working:
+            raise MpackRecursiveUseException()
+
+        cdef int result
+        cdef bint unparsing = False
+        cdef array.array[char] buf = array.clone(BYTE_ARRAY, buffer_size,
+                                                 False)
+        cdef char* b = buf.data.as_chars
+        cdef size_t bl = buffer_size
+
+        self.write = write
+        self.out_buf = buf
+        self.out_start = b
+        self.out_b = &b
+        self.out_bl = &bl
+        self.out_size = buffer_size
+
+        try:
+            for obj in objs:
+                unparsing = True
+                self.root = obj
+                while True:
+                    self.working = 1
+                    result = mpack_unparse(self.parser, &b, &bl,
+                                           unparse_enter, unparse_exit)
+                    self.working = 0
+                    self.check_exception()
+
+                    if result == MPACK_NOMEM:
+                        self.grow_parser()
+
+                    if not bl:
+                        self.flush()
+
+                    if result not in [MPACK_EOF, MPACK_NOMEM]: break
+
+                self.root = None
+                unparsing = False
+        except BaseException as e:
+            if unparsing:
+                # the parser was interrupted in the middle of an object
+                if not self.exception:
+                    self.exception = e
+            else:
+                # objs raised between objects, keep the ones already packed
+                self.flush()
+            raise
+        else:
+            self.flush()
+        finally:
+            self.write = None
+            self.out_buf = None
+            self.out_start = NULL
+            self.out_b = NULL
+            self.out_bl = NULL
+
+        assert len(self.registry) == 0
+        return 0
+
+    cdef int flush(self) except -100:
+        cdef size_t n = self.out_b[0] - self.out_start
+        if n:
+            # copied, since the buffer is reused after write returns
+            self.write(self.out_start[:n])
+        self.out_b[0] = self.out_start
+        self.out_bl[0] = self.out_size
+        return 0
+
+    cdef bytes encode(self, object obj):
+        # a Packer can't be used recursively, so cache misses are encoded by a
+        # private instance with the same options
+        if self.encoder is None:
+            self.encoder = Packer(ext=self.ext, timestamp=self.timestamp)
+        try:
+            return self.encoder(obj)
+        except BaseException:
+            # the encoder is invalid after an exception, use a new one next time
+            self.encoder = None
+            raise
+
+    cdef object cached(self, object obj):
+        """Return the cached encoding of `obj`, or None if it can't be cached.
+        """
+        if self.pinned:
+            entry = self.pinned.get(id(obj))
+            if entry is not None and entry[0] is obj:
+                self.cache_hits += 1
+                return entry[1]
+
+        if self.cache is None:
+            return None
+
+        t = type(obj)
+        if t is unicode:
+            if <size_t>len(obj) > CACHE_MAX_LEN:
+                return None
+            key = obj
+        elif t is bytes:
+            if <size_t>len(obj) > CACHE_MAX_LEN:
+                return None
+            key = (bytes, obj)
+        elif t is tuple and <size_t>len(obj) <= CACHE_MAX_TUPLE_LEN:
+            types = tuple(map(type, obj))
+            for i, item in enumerate(obj):
+                if types[i] not in CACHE_SCALARS:
+                    return None
+                if (types[i] in (unicode, bytes) and
+                        <size_t>len(item) > CACHE_MAX_LEN):
+                    return None
+            # the types are part of the key since (1,) == (True,)
+            key = (tuple, types, obj)
+        else:
+            return None
+
+        encoded = self.cache.get(key)
+        if encoded is not None:
+            self.cache_hits += 1
+            if PY_MAJOR_VERSION >= 3:
+                self.cache.move_to_end(key)
+            else:
+                self.cache[key] = self.cache.pop(key)
+            return encoded
+
+        self.cache_misses += 1
+        # str/bin are common and simple enough to skip the private Packer
+        if t is unicode:
+            payload = obj.encode('utf-8')
+            encoded = pack_chunk(mpack_pack_str(len(payload)), payload)
+        elif t is bytes:
+            encoded = pack_chunk(mpack_pack_bin(len(obj)), obj)
+        else:
+            encoded = self.encode(obj)
+        if <size_t>len(self.cache) >= self.cache_size:
+            self.cache.popitem(last=False)
+        self.cache[key] = encoded
+        return encoded
+
 
 cdef class Unpacker(Parser):
     """Encapsulate options/state for deserializing python objects from msgpack.
+
+    Timestamps(ext type -1) are decoded according to `timestamp`: 'datetime'
+    for timezone-aware `datetime` objects(truncated to microseconds), 'tuple'
+    for `(seconds, nanoseconds)`, 'int' for nanoseconds since the epoch or
+    `False` to pass them to `ext`(as code 0xff) like other ext types. The
+    default, `None`, means 'datetime' unless `ext` is a callable or a dict
+    with a 0xff entry, so that explicitly registered handlers keep working.
+
+    The `max_*` arguments bound the resources a single message may consume.
+    They are checked against each header before anything is allocated for it,
+    and `None` means unlimited. `max_alloc` is a per-message budget in bytes
+    charged with str/bin/ext payloads and one pointer per array item(two per
+    map pair).
     """
     cdef object ext
-
-    def __init__(self, ext=None):
+    cdef int timestamp
+    cdef size_t max_depth
+    cdef size_t max_container_len
+    cdef size_t max_str_len
+    cdef size_t max_bin_len
+    cdef size_t max_ext_len
+    cdef size_t max_alloc
+    cdef size_t allocated
+
+    def __init__(self, ext=None, timestamp=None, max_depth=None,
+                 max_container_len=None, max_str_len=None, max_bin_len=None,
+                 max_ext_len=None, max_alloc=None):
+        if timestamp is None:
+            timestamp = (False if callable(ext) or isinstance(ext, dict) and
+                         TIMESTAMP_EXT_READ in ext else 'datetime')
+        if timestamp not in TIMESTAMP_MODES:
+            raise ValueError(
+                "timestamp must be 'datetime', 'tuple', 'int', False or None")
+        self.timestamp = TIMESTAMP_MODES[timestamp]
+        self.max_depth = to_limit(max_depth)
+        self.max_container_len = to_limit(max_container_len)
+        self.max_str_len = to_limit(max_str_len)
+        self.max_bin_len = to_limit(max_bin_len)
+        self.max_ext_len = to_limit(max_ext_len)
+        self.max_alloc = to_limit(max_alloc)
+        self.allocated = 0
         if callable(ext):
             self.ext = ext
         elif isinstance(ext, dict):
@@ -238,6 +628,9 @@ cdef class Unpacker(Parser):
             raise ValueError('offset must be less then the input string length')
 
         self.root = None
+        if not self.parser.size:
+            # starting a new message
+            self.allocated = 0
         cdef const char* buf_init = data
         cdef const char* buf = <const char*>data + offset
         cdef size_t buflen = len(data) - offset
@@ -265,6 +658,46 @@ cdef class Unpacker(Parser):
 
         return rv
 
+    cdef object limit_error(self, mpack_uint32_t depth, mpack_token_t tok):
+        cdef size_t length = tok.length
+        cdef size_t cost = 0
+
+        if depth > self.max_depth:
+            return MpackLimitException('nesting depth', depth, 'max_depth',
+                                       self.max_depth)
+
+        if tok.type == MPACK_TOKEN_ARRAY or tok.type == MPACK_TOKEN_MAP:
+            if length > self.max_container_len:
+                return MpackLimitException(
+                    'array length' if tok.type == MPACK_TOKEN_ARRAY
+                    else 'map length', length, 'max_container_len',
+                    self.max_container_len)
+            cost = length * sizeof(void*)
+            if tok.type == MPACK_TOKEN_MAP:
+                cost *= 2
+        elif tok.type == MPACK_TOKEN_STR:
+            if length > self.max_str_len:
+                return MpackLimitException('str length', length,
+                                           'max_str_len', self.max_str_len)
+            cost = length
+        elif tok.type == MPACK_TOKEN_BIN:
+            if length > self.max_bin_len:
+                return MpackLimitException('bin length', length,
+                                           'max_bin_len', self.max_bin_len)
+            cost = length
+        elif tok.type == MPACK_TOKEN_EXT:
+            if length > self.max_ext_len:
+                return MpackLimitException('ext length', length,
+                                           'max_ext_len', self.max_ext_len)
+            cost = length
+
+        if cost > self.max_alloc - self.allocated:
+            return MpackLimitException('message allocation',
+                                       self.allocated + cost, 'max_alloc',
+                                       self.max_alloc)
+        self.allocated += cost
+        return None
+
 
 cdef class Session(Registry):
     cdef mpack_rpc_session_t *session
@@ -289,9 +722,11 @@ cdef class Session(Registry):
         if self.session:
             PyMem_Free(self.session)
     
-    def __init__(self, packer=None, unpacker=None):
+    def __init__(self, packer=None, unpacker=None, **limits):
+        if unpacker and limits:
+            raise ValueError('limits must be passed to the custom Unpacker')
         self.packer = packer or Packer()
-        self.unpacker = unpacker or Unpacker()
+        self.unpacker = unpacker or Unpacker(**limits)
 
     def request(self, method, args, data=None):
         return self.send(method, args, type=MPACK_RPC_REQUEST, data=data)
@@ -306,14 +741,38 @@ cdef class Session(Registry):
         else:
             return self.send(None, data, type=MPACK_RPC_RESPONSE,
                              data=request_id)
-        
-    def receive(self, bytes data, size_t offset=0):
-        if offset >= <size_t>len(data):
+
+    def cancel(self, data):
+        """Forget the outgoing request that was passed `data`.
+
+        This frees its slot and reference to `data`, for requests that won't
+        be answered or whose response isn't wanted anymore. Returns `False` if
+        there's no such request.
+        """
+        cdef mpack_uint32_t i
+        for i in range(self.session.capacity):
+            if (self.session.slots[i].used and
+                    self.session.slots[i].msg.data.p == <void*>data):
+                self.session.slots[i].used = 0
+                self.unref(self.session.slots[i].msg.data.p)
+                return True
+        return False
+
+    def receive(self, data, size_t offset=0):
+        cdef Py_buffer view
+        PyObject_GetBuffer(data, &view, PyBUF_SIMPLE)
+        try:
+            return self.receive_buffer(<const char*>view.buf, view.len, offset)
+        finally:
+            PyBuffer_Release(&view)
+
+    cdef receive_buffer(self, const char* data, size_t length, size_t offset):
+        if offset >= length:
             raise ValueError('offset must be less then the input string length')
 
         cdef const char* buf_init = data
-        cdef const char* buf = <const char*>data + offset
-        cdef size_t buflen = len(data) - offset
+        cdef const char* buf = data + offset
+        cdef size_t buflen = length - offset
         done = False
 
         while not done:
@@ -322,6 +781,12 @@ cdef class Session(Registry):
                                               &self.msg)
                 if self.type == MPACK_EOF:
                     break
+                if self.type == MPACK_RPC_ERESPID:
+                    # response to an unknown(e.g. cancelled) request, which
+                    # is unpacked and discarded
+                    mpack_rpc_reset_hdr(&self.session.receive)
+                # max_alloc covers the method/error and args/result together
+                self.unpacker.allocated = 0
 
             result = self.unpacker.unpack(&buf, &buflen)
 
@@ -351,19 +816,31 @@ cdef class Session(Registry):
                 return pos, 'response', me, ar, self.unref(self.msg.data.p)
             elif t == MPACK_RPC_NOTIFICATION:
                 return pos, 'notification', me, ar, None
-            else:
+            elif t != MPACK_RPC_ERESPID:
                 assert False
 
         return pos, None, None, None, None
 
     cdef send(self, method_or_error, args_or_result, int type, data=None):
-        cdef array.array[char] buf = array.array(bytes_to_native_str(b'b'),
-                                                 [0] * 8)
-        cdef char* b = buf.data.as_chars
-        cdef size_t bl = len(buf)
-        cdef size_t bl_init = bl
+        # the rpc header is at most 7 bytes
+        cdef char header[16]
+        cdef char* b = header
+        cdef size_t bl = sizeof(header)
+        cdef array.array[char] body = array.clone(BYTE_ARRAY, 64, False)
+        cdef size_t body_len = 0
         cdef mpack_data_t d
 
+        # pack the contents first, so nothing is registered for a request
+        # that can't be serialized
+        try:
+            body_len = self.packer.pack(method_or_error, body, body_len)
+            body_len = self.packer.pack(args_or_result, body, body_len)
+        except BaseException:
+            if not self.packer.working:
+                # keep the Packer usable for the other messages
+                self.packer.reset()
+            raise
+
         if type == MPACK_RPC_REQUEST:
             d.p = self.ref(data)
 
@@ -381,10 +858,8 @@ cdef class Session(Registry):
                 break
 
         assert result == MPACK_OK
-        cdef size_t pos = bl_init - bl
-        pos = self.packer.pack(method_or_error, buf, pos)
-        pos = self.packer.pack(args_or_result, buf, pos)
-        return tobytes(buf)[:pos]
+        return (header[:sizeof(header) - bl] +
+                body.data.as_chars[:body_len])
 
     cdef int grow_session(self) except -100:
         cdef mpack_uint32_t new_capacity = self.session.capacity * 2
@@ -400,6 +875,433 @@ cdef class Session(Registry):
 
 
 
+class PendingRequest(object):
+    """Response slot for a request sent by a `Connection`.
+
+    Instances are passed as the `data` of `Session.request`, so the `Session`
+    hands them back along with the matching response.
+    """
+    __slots__ = ('event', 'error', 'result', 'exception')
+
+    def __init__(self):
+        self.event = threading.Event()
+        self.error = None
+        self.result = None
+        self.exception = None
+
+    def resolve(self, error, result):
+        self.error = error
+        self.result = result
+        self.event.set()
+
+    def fail(self, exception):
+        self.exception = exception
+        self.event.set()
+
+    def wait(self, timeout=None):
+        if not self.event.wait(timeout):
+            raise MpackTimeoutException(
+                'no response after {0} seconds'.format(timeout))
+        if self.exception is not None:
+            raise self.exception
+        if self.error is not None:
+            raise MpackRemoteException(self.error)
+        return self.result
+
+
+class Connection(object):
+    """A msgpack-rpc connection shared by any number of threads.
+
+    Requests from concurrent threads are written in batches by whichever
+    thread finds the socket idle, and a background thread reads responses
+    into a reusable buffer and wakes up the threads waiting for them.
+
+    `request_handler(method, args)` and `notification_handler(method, args)`
+    are called for messages initiated by the peer, one at a time and in the
+    order they arrived, by a dispatcher thread. Handlers may therefore make
+    requests on the same connection, but incoming messages queue up while a
+    handler blocks. Once `max_queued` messages are waiting, the reader stops
+    reading from the socket until the handlers catch up, which also delays
+    the responses. Exceptions raised by `request_handler` are sent back as
+    error responses and those raised by `notification_handler` are printed.
+    Requests are answered with an error when there's no `request_handler`.
+    """
+    def __init__(self, sock, session=None, request_handler=None,
+                 notification_handler=None, buffer_size=DEFAULT_BUFFER_SIZE,
+                 max_queued=DEFAULT_MAX_QUEUED):
+        if selectors is None:
+            raise MpackException('Connection requires the selectors module')
+        self.sock = sock
+        self.session = session or Session()
+        self.request_handler = request_handler
+        self.notification_handler = notification_handler
+        self.buffer_size = buffer_size
+        # guards the Session and everything below
+        self.lock = threading.Lock()
+        self.pending = set()
+        self.outgoing = []
+        self.flushing = False
+        self.closed = False
+        self.error = None
+        # writing to wakeup_w interrupts the reader's select()
+        self.wakeup_r, self.wakeup_w = socket.socketpair()
+        # messages initiated by the peer, then None once closed unless the
+        # queue is full(see dispatch_loop)
+        self.incoming = queue.Queue(max_queued)
+        self.reader = threading.Thread(target=self.read_loop)
+        self.reader.daemon = True
+        self.reader.start()
+        self.dispatcher = threading.Thread(target=self.dispatch_loop)
+        self.dispatcher.daemon = True
+        self.dispatcher.start()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def in_flight(self):
+        """Number of requests waiting for a response."""
+        return len(self.pending)
+
+    def request(self, method, args, timeout=None):
+        """Send a request and wait for its result.
+
+        Raises `MpackRemoteException` if the peer replies with an error and
+        `MpackTimeoutException` if there's no reply after `timeout` seconds.
+        """
+        pending = PendingRequest()
+        with self.lock:
+            self.check_open()
+            self.outgoing.append(
+                self.session.request(method, args, data=pending))
+            self.pending.add(pending)
+        self.flush()
+        try:
+            return pending.wait(timeout)
+        finally:
+            with self.lock:
+                self.pending.discard(pending)
+                if not pending.event.is_set():
+                    # free its slot in the Session, a late response is
+                    # discarded
+                    self.session.cancel(pending)
+
+    def notify(self, method, args):
+        """Send a notification.
+
+        Raises `MpackConnectionException` if the connection is found to have
+        failed by the time the notification was handed to the socket, in
+        which case it may not have been written. Like any write to a socket,
+        returning doesn't mean the peer received it.
+        """
+        with self.lock:
+            self.check_open()
+            self.outgoing.append(self.session.notify(method, args))
+        self.flush()
+        # another thread may have been writing the batch that includes it
+        self.check_open()
+
+    def close(self):
+        self.fail(MpackConnectionException('connection closed'))
+        # wait for the messages already received to be handled, unless a
+        # handler is closing the connection itself
+        for thread in self.reader, self.dispatcher:
+            if thread is not threading.current_thread():
+                thread.join()
+
+    def check_open(self):
+        if self.closed:
+            raise MpackConnectionException(
+                'connection is closed: {0}'.format(self.error))
+
+    def flush(self):
+        """Write the outgoing messages unless another thread is doing it.
+
+        Raises `MpackConnectionException` if writing fails.
+        """
+        while True:
+            with self.lock:
+                if self.flushing or not self.outgoing or self.closed:
+                    return
+                self.flushing = True
+                batch, self.outgoing = self.outgoing, []
+            try:
+                self.send(batch)
+            except Exception as e:
+                self.fail(e)
+                self.check_open()
+            finally:
+                with self.lock:
+                    self.flushing = False
+
+    def send(self, batch):
+        sendmsg = getattr(self.sock, 'sendmsg', None)
+        if not sendmsg:
+            self.sock.sendall(b''.join(batch))
+            return
+        batch = [memoryview(msg) for msg in batch]
+        while batch:
+            sent = sendmsg(batch[:SENDMSG_MAX_BUFFERS])
+            while sent:
+                if sent < len(batch[0]):
+                    batch[0] = batch[0][sent:]
+                    break
+                sent -= len(batch[0])
+                batch.pop(0)
+
+    def fail(self, exception):
+        with self.lock:
+            if self.closed:
+                return
+            self.closed = True
+            self.error = exception
+            pending, self.pending = self.pending, set()
+            self.wakeup_w.send(b'x')
+            try:
+                self.incoming.put_nowait(None)
+            except queue.Full:
+                pass
+        for p in pending:
+            p.fail(exception if isinstance(exception, MpackException)
+                   else MpackConnectionException(exception))
+
+    def read_loop(self):
+        buf = bytearray(self.buffer_size)
+        view = memoryview(buf)
+        selector = selectors.DefaultSelector()
+        selector.register(self.sock, selectors.EVENT_READ)
+        selector.register(self.wakeup_r, selectors.EVENT_READ)
+        try:
+            while not self.closed:
+                selector.select()
+                if self.closed:
+                    break
+                n = self.sock.recv_into(buf)
+                if not n:
+                    raise MpackConnectionException(
+                        'connection closed by peer')
+                offset = 0
+                while offset < n and not self.closed:
+                    with self.lock:
+                        offset, t, method_or_error, args_or_result, data = (
+                            self.session.receive(view[:n], offset))
+                    if t == 'response':
+                        data.resolve(method_or_error, args_or_result)
+                    elif t is not None:
+                        self.incoming.put((t, data, method_or_error,
+                                           args_or_result))
+        except Exception as e:
+            self.fail(e)
+        finally:
+            selector.close()
+            with self.lock:
+                self.sock.close()
+                self.wakeup_r.close()
+                self.wakeup_w.close()
+
+    def dispatch_loop(self):
+        while True:
+            if self.closed and self.incoming.empty():
+                # fail couldn't queue None
+                return
+            message = self.incoming.get()
+            if message is None:
+                return
+            t, msgid, method, args = message
+            if t == 'request':
+                self.handle_request(msgid, method, args)
+            elif self.notification_handler:
+                try:
+                    self.notification_handler(method, args)
+                except Exception:
+                    traceback.print_exc()
+
+    def handle_request(self, msgid, method, args):
+        if self.request_handler:
+            try:
+                result, error = self.request_handler(method, args), False
+            except Exception as e:
+                result, error = repr(e), True
+        else:
+            result, error = 'no request handler', True
+        with self.lock:
+            if self.closed:
+                return
+            try:
+                reply = self.session.reply(msgid, result, error)
+            except MpackException as e:
+                reply = self.session.reply(msgid, repr(e), True)
+            self.outgoing.append(reply)
+        try:
+            self.flush()
+        except MpackConnectionException:
+            # the connection failed, which was reported to its users
+            pass
+
+
+class Client(object):
+    """Pool of up to `size` `Connection` objects to `address`.
+
+    Connections are opened on demand and each request goes to the connection
+    with the fewest requests in flight. `session_factory` creates the
+    `Session` of each connection, which allows custom Packer/Unpacker
+    instances and decoding limits. Errors raised by `connect` are reported as
+    `MpackConnectionException`.
+    """
+    def __init__(self, address, size=4, session_factory=Session,
+                 connect=socket.create_connection, **connection_options):
+        self.address = address
+        self.size = size
+        self.session_factory = session_factory
+        self.connect = connect
+        self.connection_options = connection_options
+        self.lock = threading.Lock()
+        # notified when a connection attempt ends
+        self.connected = threading.Condition(self.lock)
+        self.connections = []
+        # connections being opened, which count towards `size`
+        self.connecting = 0
+        self.closed = False
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def request(self, method, args, timeout=None):
+        return self.connection().request(method, args, timeout)
+
+    def notify(self, method, args):
+        self.connection().notify(method, args)
+
+    def connection(self):
+        with self.lock:
+            while True:
+                if self.closed:
+                    raise MpackConnectionException('client is closed')
+                self.connections = [c for c in self.connections
+                                    if not c.closed]
+                opened = len(self.connections) + self.connecting
+                if self.connections:
+                    conn = min(self.connections, key=Connection.in_flight)
+                    if not conn.in_flight() or opened >= self.size:
+                        return conn
+                if opened < self.size:
+                    break
+                self.connected.wait()
+            self.connecting += 1
+        # connect without the lock, so other threads can keep using the
+        # open connections meanwhile
+        try:
+            try:
+                sock = self.connect(self.address)
+            except socket.error as e:
+                raise MpackConnectionException(
+                    'cannot connect to {0}: {1}'.format(self.address, e))
+            conn = Connection(sock, session=self.session_factory(),
+                              **self.connection_options)
+        except BaseException:
+            with self.lock:
+                self.connecting -= 1
+                self.connected.notify_all()
+            raise
+        with self.lock:
+            self.connecting -= 1
+            self.connected.notify_all()
+            if not self.closed:
+                self.connections.append(conn)
+                return conn
+        conn.close()
+        raise MpackConnectionException('client is closed')
+
+    def close(self):
+        with self.lock:
+            self.closed = True
+            connections, self.connections = self.connections, []
+        for conn in connections:
+            conn.close()
+
+
+cdef bytes pack_chunk(mpack_token_t tok, bytes payload):
+    """Return the encoding of a str/bin/ext header followed by `payload`."""
+    cdef mpack_tokbuf_t tb
+    cdef char header[16]
+    cdef char* b = header
+    cdef size_t bl = sizeof(header)
+    mpack_tokbuf_init(&tb)
+    mpack_write(&tb, &b, &bl, &tok)
+    return header[:sizeof(header) - bl] + payload
+
+
+cdef inline void write_be32(char* b, mpack_uint32_t v):
+    b[0] = <char>(v >> 24)
+    b[1] = <char>(v >> 16)
+    b[2] = <char>(v >> 8)
+    b[3] = <char>v
+
+
+cdef inline mpack_uint32_t read_be32(const unsigned char* b):
+    return (<mpack_uint32_t>b[0] << 24 | <mpack_uint32_t>b[1] << 16 |
+            <mpack_uint32_t>b[2] << 8 | <mpack_uint32_t>b[3])
+
+
+cdef bytes pack_timestamp(object dt):
+    cdef char b[12]
+    delta = dt - EPOCH
+    cdef long long seconds = delta.days * 86400 + delta.seconds
+    cdef mpack_uint32_t nsec = delta.microseconds * 1000
+    cdef unsigned long long data64
+
+    if seconds >> 34 == 0:
+        data64 = <unsigned long long>nsec << 34 | <unsigned long long>seconds
+        if data64 >> 32 == 0:
+            # timestamp 32
+            write_be32(b, <mpack_uint32_t>data64)
+            return b[:4]
+        # timestamp 64
+        write_be32(b, <mpack_uint32_t>(data64 >> 32))
+        write_be32(b + 4, <mpack_uint32_t>data64)
+        return b[:8]
+    # timestamp 96
+    write_be32(b, nsec)
+    write_be32(b + 4, <mpack_uint32_t>(<unsigned long long>seconds >> 32))
+    write_be32(b + 8, <mpack_uint32_t>seconds)
+    return b[:12]
+
+
+cdef object unpack_timestamp(array.array data, int mode):
+    cdef const unsigned char* b = data.data.as_uchars
+    cdef long long seconds
+    cdef mpack_uint32_t nsec
+    cdef unsigned long long data64
+
+    if len(data) == 4:
+        seconds = read_be32(b)
+        nsec = 0
+    elif len(data) == 8:
+        data64 = <unsigned long long>read_be32(b) << 32 | read_be32(b + 4)
+        seconds = data64 & 0x3ffffffff
+        nsec = data64 >> 34
+    elif len(data) == 12:
+        nsec = read_be32(b)
+        seconds = <long long>(<unsigned long long>read_be32(b + 4) << 32 |
+                              read_be32(b + 8))
+    else:
+        raise ValueError('length must be 4, 8 or 12, got {0}'.format(
+            len(data)))
+
+    if nsec > 999999999:
+        raise ValueError('nanoseconds out of range')
+    if mode == TIMESTAMP_TUPLE:
+        return seconds, nsec
+    if mode == TIMESTAMP_INT:
+        return <object>seconds * 1000000000 + nsec
+    return EPOCH + timedelta(seconds=seconds, microseconds=nsec // 1000)
+
+
 cdef void unparse_enter(mpack_parser_t* parser, mpack_node_t* node):
     cdef mpack_node_t* parent = MPACK_PARENT_NODE(node)
     cdef Packer packer = <Packer>parser.data.p
@@ -408,7 +1310,21 @@ cdef void unparse_enter(mpack_parser_t* parser, mpack_node_t* node):
         parent_obj = <object>parent.data[0].p
 
         if parent.tok.type > MPACK_TOKEN_MAP:
-            node.tok = mpack_pack_chunk(parent_obj, parent.tok.length)
+            if (packer.write is not None and
+                    parent.tok.length >= packer.out_size // 2):
+                # everything up to the header is in the buffer, so flush it
+                # and write the payload directly, leaving an empty chunk in
+                # its place(see unparse_exit)
+                try:
+                    packer.flush()
+                    packer.write(parent_obj)
+                except Exception as e:
+                    packer.exception = e
+                if packer.exception:
+                    MPACK_THROW(parser)
+                node.tok = mpack_pack_chunk(parent_obj, 0)
+            else:
+                node.tok = mpack_pack_chunk(parent_obj, parent.tok.length)
             return
 
         if parent.tok.type == MPACK_TOKEN_ARRAY:
@@ -429,6 +1345,19 @@ cdef void unparse_enter(mpack_parser_t* parser, mpack_node_t* node):
     else:
         obj = packer.root
 
+    if packer.cache is not None or packer.pinned:
+        try:
+            encoded = packer.cached(obj)
+        except Exception as e:
+            packer.exception = e
+        if packer.exception:
+            MPACK_THROW(parser)
+        if encoded is not None:
+            # emit the encoding verbatim, see unparse_exit
+            node.tok = mpack_pack_chunk(encoded, len(encoded))
+            packer.chunk = encoded
+            return
+
     if isinstance(obj, bool):
         node.tok = mpack_pack_boolean(<unsigned>obj)
     elif isinstance(obj, (int, long)):
@@ -449,6 +1378,10 @@ cdef void unparse_enter(mpack_parser_t* parser, mpack_node_t* node):
     elif isinstance(obj, dict):
         node.tok = mpack_pack_map(len(obj))
         obj = iter(obj.items())
+    elif (packer.timestamp and isinstance(obj, datetime) and
+          obj.utcoffset() is not None):
+        obj = pack_timestamp(obj)
+        node.tok = mpack_pack_ext(TIMESTAMP_EXT, len(obj))
     elif packer.ext:
         try:
             codeobj = packer.ext(obj)
@@ -479,8 +1412,29 @@ cdef void unparse_enter(mpack_parser_t* parser, mpack_node_t* node):
 
 cdef void unparse_exit(mpack_parser_t* parser, mpack_node_t* node):
     cdef Packer packer = <Packer>parser.data.p
+    cdef mpack_node_t* parent = MPACK_PARENT_NODE(node)
     if node.tok.type != MPACK_TOKEN_CHUNK:
         packer.unref(node.data[0].p)
+        return
+
+    if parent and parent.tok.type > MPACK_TOKEN_MAP:
+        # str/bin/ext payload. Empty chunks stand for payloads that were
+        # written directly by dump, so mark the parent as complete
+        if not node.tok.length:
+            parent.pos = parent.tok.length
+        return
+
+    # cached encoding. The walker advanced the parent by the chunk length, so
+    # fix it up to count a single array item or map key/value instead
+    packer.chunk = None
+    if parent:
+        parent.pos -= node.tok.length
+        if parent.tok.type == MPACK_TOKEN_MAP:
+            if parent.key_visited:
+                parent.pos += 1
+            parent.key_visited = not parent.key_visited
+        else:
+            parent.pos += 1
 
 
 cdef void parse_enter(mpack_parser_t* parser, mpack_node_t* node):
@@ -490,6 +1444,12 @@ cdef void parse_enter(mpack_parser_t* parser, mpack_node_t* node):
     cdef Unpacker unpacker = <Unpacker>parser.data.p
     obj = None
 
+    if node.tok.type != MPACK_TOKEN_CHUNK:
+        err = unpacker.limit_error(parser.size, node.tok)
+        if err is not None:
+            unpacker.exception = err
+            MPACK_THROW(parser)
+
     if node.tok.type == MPACK_TOKEN_BOOLEAN:
         obj = True if mpack_unpack_boolean(node.tok) else False
     elif node.tok.type == MPACK_TOKEN_UINT:
@@ -505,7 +1465,7 @@ cdef void parse_enter(mpack_parser_t* parser, mpack_node_t* node):
         memcpy(b + parent.pos, node.tok.data.chunk_ptr, node.tok.length)
         return
     elif node.tok.type in [MPACK_TOKEN_BIN, MPACK_TOKEN_STR, MPACK_TOKEN_EXT]:
-        obj = array.array(bytes_to_native_str(b'b'), node.tok.length * [0])
+        obj = array.clone(BYTE_ARRAY, node.tok.length, False)
     elif node.tok.type == MPACK_TOKEN_ARRAY:
         obj = []
     elif node.tok.type == MPACK_TOKEN_MAP:
@@ -523,7 +1483,16 @@ cdef void parse_exit(mpack_parser_t* parser, mpack_node_t* node):
     cdef Unpacker unpacker = <Unpacker>parser.data.p
     obj = unpacker.unref(node.data[0].p)
 
-    if node.tok.type in [MPACK_TOKEN_BIN, MPACK_TOKEN_STR, MPACK_TOKEN_EXT]:
+    if (node.tok.type == MPACK_TOKEN_EXT and unpacker.timestamp and
+            node.tok.data.ext_type == TIMESTAMP_EXT_READ):
+        try:
+            obj = unpack_timestamp(obj, unpacker.timestamp)
+        except (ValueError, OverflowError) as e:
+            unpacker.exception = MpackException(
+                'invalid timestamp: {0}'.format(e))
+        if unpacker.exception:
+            MPACK_THROW(parser)
+    elif node.tok.type in [MPACK_TOKEN_BIN, MPACK_TOKEN_STR, MPACK_TOKEN_EXT]:
         obj = tobytes(obj)
         if node.tok.type == MPACK_TOKEN_STR:
             obj = obj.decode('utf-8')
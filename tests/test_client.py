@@ -0,0 +1,314 @@
+import functools
+import operator
+import socket
+import threading
+import time
+import unittest
+
+import mpack
+
+
+class LoopbackServer(object):
+    """msgpack-rpc server on 127.0.0.1 with one thread per connection.
+
+    'add' returns the sum of its arguments, 'sleep' replies after the given
+    number of seconds, 'fail' replies with an error, 'notify_me' sends a
+    notification before replying, 'call_me' replies with the result of
+    calling the given method back on the client and 'drop' closes the
+    connection.
+    """
+    def __init__(self):
+        self.sock = socket.socket()
+        self.sock.bind(('127.0.0.1', 0))
+        self.sock.listen(16)
+        self.address = self.sock.getsockname()
+        self.connections = 0
+        thread = threading.Thread(target=self.accept_loop)
+        thread.daemon = True
+        thread.start()
+
+    def close(self):
+        self.sock.close()
+
+    def accept_loop(self):
+        while True:
+            try:
+                conn, _ = self.sock.accept()
+            except socket.error:
+                return
+            self.connections += 1
+            thread = threading.Thread(target=self.serve, args=(conn,))
+            thread.daemon = True
+            thread.start()
+
+    def serve(self, conn):
+        session = mpack.Session()
+        # Session isn't thread-safe
+        lock = threading.Lock()
+
+        def reply(msgid, method, args):
+            if method == u'sleep':
+                time.sleep(args[0])
+            with lock:
+                if method == u'fail':
+                    data = session.reply(msgid, u'failed', error=True)
+                elif method == u'notify_me':
+                    data = (session.notify(u'note', args) +
+                            session.reply(msgid, None))
+                else:
+                    data = session.reply(msgid,
+                                         functools.reduce(operator.add, args))
+                try:
+                    conn.sendall(data)
+                except socket.error:
+                    pass
+
+        with conn:
+            while True:
+                data = conn.recv(4096)
+                if not data:
+                    return
+                offset = 0
+                while offset < len(data):
+                    with lock:
+                        offset, t, method, args, msgid = session.receive(
+                            data, offset)
+                    if t == 'response':
+                        # answer to a 'call_me' request, msgid is its id
+                        error = method is not None
+                        with lock:
+                            conn.sendall(session.reply(
+                                msgid, method if error else args, error))
+                        continue
+                    if t != 'request':
+                        continue
+                    if method == u'drop':
+                        return
+                    if method == u'call_me':
+                        with lock:
+                            conn.sendall(session.request(args[0], args[1:],
+                                                         data=msgid))
+                        continue
+                    thread = threading.Thread(target=reply,
+                                              args=(msgid, method, args))
+                    thread.daemon = True
+                    thread.start()
+
+
+class TestClient(unittest.TestCase):
+    def setUp(self):
+        self.server = LoopbackServer()
+        self.client = mpack.Client(self.server.address, size=2)
+
+    def tearDown(self):
+        self.client.close()
+        self.server.close()
+
+    def test_request(self):
+        self.assertEqual(self.client.request(u'add', [1, 2]), 3)
+        self.assertEqual(self.client.request(u'add', [u'a', u'b']), u'ab')
+
+    def test_concurrent_requests(self):
+        results = {}
+
+        def worker(i):
+            results[i] = self.client.request(u'add', [i, 1000], timeout=10)
+
+        threads = [threading.Thread(target=worker, args=(i,))
+                   for i in range(64)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(results, dict((i, i + 1000) for i in range(64)))
+        self.assertLessEqual(self.server.connections, 2)
+
+    def test_responses_out_of_order(self):
+        results = []
+        slow = threading.Thread(target=lambda: results.append(
+            self.client.request(u'sleep', [0.5], timeout=10)))
+        slow.start()
+        time.sleep(0.1)
+        conn = self.client.connection()
+        self.assertEqual(conn.request(u'add', [1, 1], timeout=10), 2)
+        self.assertEqual(results, [])
+        slow.join()
+        self.assertEqual(results, [0.5])
+
+    def test_remote_error(self):
+        with self.assertRaises(mpack.MpackRemoteException) as cm:
+            self.client.request(u'fail', [0])
+        self.assertEqual(cm.exception.error, u'failed')
+
+    def test_timeout(self):
+        with self.assertRaises(mpack.MpackTimeoutException):
+            self.client.request(u'sleep', [0.5], timeout=0.05)
+
+    def test_late_response(self):
+        conn = self.client.connection()
+        with self.assertRaises(mpack.MpackTimeoutException):
+            conn.request(u'sleep', [0.2], timeout=0.05)
+        time.sleep(0.3)
+        # the response to the cancelled request was discarded
+        self.assertFalse(conn.closed)
+        self.assertEqual(conn.request(u'add', [1, 2], timeout=10), 3)
+
+    def test_max_queued(self):
+        release = threading.Event()
+        client = mpack.Client(self.server.address, size=1, max_queued=2,
+                              notification_handler=lambda m, a:
+                              release.wait(10))
+        with client:
+            conn = client.connection()
+            threads = [threading.Thread(target=conn.request,
+                                        args=(u'notify_me', [i], 10))
+                       for i in range(8)]
+            for thread in threads:
+                thread.start()
+            time.sleep(0.3)
+            # the reader waits for the handler instead of queueing more
+            self.assertLessEqual(conn.incoming.qsize(), 2)
+            self.assertGreater(conn.in_flight(), 0)
+            release.set()
+            for thread in threads:
+                thread.join()
+            self.assertEqual(conn.in_flight(), 0)
+
+    def test_notification_handler(self):
+        notes = []
+        client = mpack.Client(self.server.address,
+                              notification_handler=lambda m, a:
+                              notes.append((m, a)))
+        with client:
+            client.request(u'notify_me', [1, 2])
+        self.assertEqual(notes, [(u'note', [1, 2])])
+
+    def test_raising_notification_handler(self):
+        notes = []
+
+        def handler(method, args):
+            notes.append(args)
+            raise ValueError('handler failed')
+
+        client = mpack.Client(self.server.address, size=1,
+                              notification_handler=handler)
+        with client:
+            client.request(u'notify_me', [1])
+            # the connection survives the handler's exception
+            client.request(u'notify_me', [2], timeout=10)
+            self.assertEqual(client.request(u'add', [1, 2], timeout=10), 3)
+        self.assertEqual(notes, [[1], [2]])
+
+    def test_request_handler(self):
+        def handler(method, args):
+            if method == u'fail':
+                raise ValueError('handler failed')
+            # handlers may make requests on the same connection
+            return client.request(method, args, timeout=10)
+
+        client = mpack.Client(self.server.address, size=1,
+                              request_handler=handler)
+        with client:
+            self.assertEqual(
+                client.request(u'call_me', [u'add', 1, 2], timeout=10), 3)
+            with self.assertRaises(mpack.MpackRemoteException):
+                client.request(u'call_me', [u'fail'], timeout=10)
+            self.assertEqual(
+                client.request(u'call_me', [u'add', 3, 4], timeout=10), 7)
+
+    def test_connection_lost(self):
+        conn = self.client.connection()
+        with self.assertRaises(mpack.MpackConnectionException):
+            conn.request(u'drop', [0], timeout=10)
+        with self.assertRaises(mpack.MpackConnectionException):
+            conn.request(u'add', [1, 2])
+        # the client replaces the dead connection
+        self.assertEqual(self.client.request(u'add', [1, 2]), 3)
+
+    def test_unpackable_arguments(self):
+        class Unpackable(object):
+            pass
+
+        def refuse(obj):
+            raise ValueError('unpackable')
+
+        client = mpack.Client(self.server.address, session_factory=lambda:
+                              mpack.Session(packer=mpack.Packer(
+                                  ext={Unpackable: refuse})))
+        with client:
+            conn = client.connection()
+            with self.assertRaises(mpack.MpackUserException):
+                conn.request(u'add', [Unpackable()])
+            self.assertEqual(conn.in_flight(), 0)
+            # the connection and its Session stay usable
+            self.assertEqual(conn.request(u'add', [1, 2], timeout=10), 3)
+
+    def test_notify_write_error(self):
+        sock, peer = socket.socketpair()
+        with peer, mpack.Connection(sock) as conn:
+            # the peer stays open, so only the write reports the failure
+            sock.shutdown(socket.SHUT_WR)
+            with self.assertRaises(mpack.MpackConnectionException):
+                conn.notify(u'add', [1, 2])
+
+    def test_connect_error(self):
+        sock = socket.socket()
+        sock.bind(('127.0.0.1', 0))
+        address = sock.getsockname()
+        sock.close()
+        with mpack.Client(address) as client:
+            with self.assertRaises(mpack.MpackConnectionException):
+                client.request(u'add', [1, 2])
+
+    def test_connect_without_lock(self):
+        connecting = threading.Event()
+        proceed = threading.Event()
+        proceed.set()
+
+        def slow_connect(address):
+            connecting.set()
+            proceed.wait(10)
+            return socket.create_connection(address)
+
+        client = mpack.Client(self.server.address, size=2,
+                              connect=slow_connect)
+        with client:
+            client.connection()
+            connecting.clear()
+            proceed.clear()
+            slow = threading.Thread(target=lambda: client.request(
+                u'sleep', [0.5], timeout=10))
+            slow.start()
+            time.sleep(0.1)
+            # the busy connection makes this open a second one
+            opener = threading.Thread(target=client.connection)
+            opener.start()
+            self.assertTrue(connecting.wait(10))
+            # which doesn't block requests on the first
+            start = time.time()
+            self.assertEqual(client.request(u'add', [1, 2], timeout=10), 3)
+            self.assertLess(time.time() - start, 5)
+            proceed.set()
+            opener.join()
+            slow.join()
+
+    def test_close_fails_pending_requests(self):
+        conn = self.client.connection()
+        errors = []
+
+        def worker():
+            try:
+                conn.request(u'sleep', [1], timeout=10)
+            except mpack.MpackConnectionException as e:
+                errors.append(e)
+
+        thread = threading.Thread(target=worker)
+        thread.start()
+        time.sleep(0.1)
+        conn.close()
+        thread.join()
+        self.assertEqual(len(errors), 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,4 +1,8 @@
 from hypothesis import given
+from hypothesis.strategies import datetimes, integers, just
+from datetime import datetime
+import io
+import timeit
 import unittest
 
 import mpack
@@ -24,6 +28,180 @@ class TestMpack(unittest.TestCase, compat.SubTestMixin):
                 self.assertEqual(n, len(packed_obj))
                 self.assertEqual(unpacked_obj, obj)
 
+    @given(strategies.everything())
+    def test_pack_cached(self, x):
+        packed_obj, obj = x
+        unpacked_obj, _ = mpack.Unpacker(ext=strategies.ext_unpack)(packed_obj)
+        expected = mpack.Packer()(unpacked_obj)
+        pack = mpack.Packer(cache_size=4)
+        self.assertEqual(pack(unpacked_obj), expected)
+        self.assertEqual(pack([unpacked_obj, unpacked_obj]),
+                         b"\x92" + expected * 2)
+
+    @given(strategies.everything(), integers(min_value=1, max_value=64))
+    def test_dump(self, x, buffer_size):
+        packed_obj, obj = x
+        unpacked_obj, _ = mpack.Unpacker(ext=strategies.ext_unpack)(packed_obj)
+        expected = mpack.Packer()(unpacked_obj)
+        f = io.BytesIO()
+        mpack.Packer().dump_many([unpacked_obj] * 2, f, buffer_size)
+        self.assertEqual(f.getvalue(), expected * 2)
+
+    def test_dump_writes_large_payloads_directly(self):
+        class Writer(object):
+            def __init__(self):
+                self.chunks = []
+            def write(self, data):
+                self.chunks.append(data)
+        payload = b"x" * 1000
+        writer = Writer()
+        mpack.Packer().dump([payload, u"y" * 10], writer, buffer_size=16)
+        self.assertTrue(any(c is payload for c in writer.chunks))
+        self.assertTrue(all(len(c) <= 16 for c in writer.chunks
+                            if c is not payload))
+        self.assertEqual(b"".join(writer.chunks),
+                         mpack.pack([payload, u"y" * 10]))
+
+    def test_dump_writer_keeps_chunks(self):
+        chunks = []
+        class Writer(object):
+            write = chunks.append
+        mpack.Packer().dump(list(range(100)), Writer(), buffer_size=16)
+        self.assertEqual(b"".join(chunks), mpack.pack(list(range(100))))
+
+    def test_dump_many_iterator_error(self):
+        def objs():
+            yield 1
+            yield [2, 3]
+            raise KeyError("objs")
+        f = io.BytesIO()
+        pack = mpack.Packer()
+        with self.assertRaises(KeyError):
+            pack.dump_many(objs(), f)
+        self.assertEqual(f.getvalue(), b"\x01\x92\x02\x03")
+        # the packer is still usable
+        self.assertEqual(pack([4]), b"\x91\x04")
+
+    def test_dump_to_send(self):
+        class Socket(object):
+            def __init__(self):
+                self.data = b""
+            def send(self, data):
+                self.data += bytes(data[:3])
+                return min(len(data), 3)
+        sock = Socket()
+        mpack.Packer().dump({u"k": list(range(20))}, sock, buffer_size=8)
+        self.assertEqual(sock.data, mpack.pack({u"k": list(range(20))}))
+
+    def test_dump_to_raw_file(self):
+        class RawFile(io.RawIOBase):
+            def __init__(self):
+                self.data = b""
+            def writable(self):
+                return True
+            def write(self, data):
+                self.data += bytes(data[:3])
+                return min(len(data), 3)
+        obj = {u"k": list(range(20)), u"s": u"x" * 20}
+        f = RawFile()
+        mpack.Packer().dump(obj, f, buffer_size=8)
+        self.assertEqual(f.data, mpack.pack(obj))
+
+    def test_cache_stats(self):
+        pack = mpack.Packer(cache_size=2)
+        self.assertEqual(pack([u"a", b"a", (1,), (True,), u"a"]),
+                         b"\x95\xa1a\xc4\x01a\x91\x01\x91\xc3\xa1a")
+        # the LRU cache only holds (1,) and (True,) by the time u"a" repeats
+        self.assertEqual((pack.cache_hits, pack.cache_misses), (0, 5))
+        self.assertEqual(pack([(True,), 1.5, [u"a"]]),
+                         b"\x93\x91\xc3\xca?\xc0\x00\x00\x91\xa1a")
+        self.assertEqual((pack.cache_hits, pack.cache_misses), (2, 5))
+        pack.clear_cache()
+        self.assertEqual((pack.cache_hits, pack.cache_misses), (0, 0))
+
+    def test_session_cancel(self):
+        session = mpack.Session()
+        data = object()
+        session.request(u"m", [], data=data)
+        self.assertTrue(session.cancel(data))
+        self.assertFalse(session.cancel(data))
+        # the late response is discarded, the following message isn't
+        msg = b"\x94\x01\x00\xc0\x01\x93\x02\xa1n\x90"
+        self.assertEqual(session.receive(msg), (5, None, None, None, None))
+        self.assertEqual(session.receive(msg, 5),
+                         (10, u"notification", u"n", [], None))
+
+    def test_cache_hits_are_cheaper(self):
+        # method names are what the cache is for, so a hit must beat
+        # encoding the name again
+        sessions = (mpack.Session(),
+                    mpack.Session(packer=mpack.Packer(cache_size=16)))
+        best = [float("inf")] * 2
+        for _ in range(5):
+            for i, session in enumerate(sessions):
+                best[i] = min(best[i], timeit.timeit(
+                    lambda: session.notify(u"nvim_buf_set_lines", [1]),
+                    number=2000))
+        self.assertLess(best[1], best[0])
+
+    def test_cache_object_error(self):
+        class Bad(object):
+            pass
+
+        def boom(obj):
+            raise ValueError('boom')
+
+        pack = mpack.Packer(cache_size=4, ext={Bad: boom})
+        with self.assertRaises(mpack.MpackUserException):
+            pack.cache_object([Bad()])
+        # the failed encoding doesn't affect later cache misses
+        self.assertEqual(pack([u"abc"]), b"\x91\xa3abc")
+        self.assertEqual(pack.cache_misses, 1)
+
+    @given(datetimes(timezones=just(mpack.UTC)))
+    def test_pack_unpack_timestamp(self, dt):
+        packed = mpack.pack(dt)
+        self.assertEqual(mpack.unpack(packed), dt)
+        seconds, nsec = mpack.Unpacker(timestamp='tuple')(packed)[0]
+        self.assertEqual(nsec, dt.microsecond * 1000)
+        self.assertEqual(mpack.Unpacker(timestamp='int')(packed)[0],
+                         seconds * 10 ** 9 + nsec)
+
+    def test_unpacking_invalid_timestamp(self):
+        bad_length = b"\xd5\xff\x00\x00"
+        bad_nsec = b"\xd7\xff\xff\xff\xff\xff\x00\x00\x00\x00"
+        for data in (bad_length, bad_nsec,
+                     b"\x92" + bad_length + b"\x01",
+                     b"\x92" + bad_nsec + bad_nsec,
+                     b"\x81\x01" + bad_length,
+                     b"\x82" + bad_nsec + b"\x01\x02\x03"):
+            with self.subTest(data=data):
+                unpack = mpack.Unpacker()
+                with self.assertRaises(mpack.MpackException):
+                    unpack(data)
+
+    def test_packing_timestamp_with_ext(self):
+        dt = datetime(2020, 1, 1, tzinfo=mpack.UTC)
+        native = b"\xd6\xff^\x0b\xe1\x00"
+        handled = b"\xd4\x01\x00"
+        handler = lambda obj: (1, b"\x00")
+        self.assertEqual(mpack.Packer(ext={datetime: handler})(dt), handled)
+        self.assertEqual(mpack.Packer(ext=handler)(dt), handled)
+        self.assertEqual(mpack.Packer(ext=handler, timestamp=True)(dt), native)
+        self.assertEqual(mpack.Packer(ext={int: handler})(dt), native)
+
+    def test_unpacking_timestamp_with_ext(self):
+        data = b"\xd6\xff^\x0b\xe1\x00"
+        dt = datetime(2020, 1, 1, tzinfo=mpack.UTC)
+        handler = lambda code, obj: (code, obj)
+        self.assertEqual(mpack.Unpacker(ext={0xff: handler})(data)[0],
+                         (0xff, b"^\x0b\xe1\x00"))
+        self.assertEqual(mpack.Unpacker(ext=handler)(data)[0],
+                         (0xff, b"^\x0b\xe1\x00"))
+        self.assertEqual(
+            mpack.Unpacker(ext=handler, timestamp="datetime")(data)[0], dt)
+        self.assertEqual(mpack.Unpacker(ext={5: handler})(data)[0], dt)
+
     def test_unpacking_c1(self):
         unpack = mpack.Unpacker()
         with self.assertRaises(mpack.MpackException):
@@ -38,6 +216,49 @@ class TestMpack(unittest.TestCase, compat.SubTestMixin):
         unpack = mpack.Unpacker(ext={})
         self.assertEqual(unpack(b"\xc0"), (None, 1))
 
+    def test_unpacking_with_raising_ext(self):
+        def ext(code, data):
+            raise ValueError(code)
+        for data in (b"\x92\xd4\x05x\x01", b"\x81\xd4\x05x\x01",
+                     b"\x81\x01\xd4\x05x"):
+            with self.subTest(data=data):
+                unpack = mpack.Unpacker(ext=ext)
+                with self.assertRaises(mpack.MpackUserException):
+                    unpack(data)
+
+    def test_unpacking_beyond_limits(self):
+        cases = [
+            ({'max_depth': 1}, b"\x91\x01"),
+            ({'max_container_len': 1}, b"\x82\x01\x02\x03\x04"),
+            ({'max_str_len': 1}, b"\xdb\xff\xff\xff\xff"),
+            ({'max_bin_len': 1}, b"\xc6\xff\xff\xff\xff"),
+            ({'max_ext_len': 1}, b"\xc9\xff\xff\xff\xff\x05"),
+            ({'max_alloc': 4}, b"\xa5hello"),
+        ]
+        for limits, data in cases:
+            with self.subTest(limits=limits):
+                unpack = mpack.Unpacker(**limits)
+                with self.assertRaises(mpack.MpackLimitException):
+                    while data:
+                        _, n = unpack(data)
+                        data = data[n:]
+
+    def test_unpacking_within_limits(self):
+        unpack = mpack.Unpacker(max_depth=3, max_container_len=2,
+                                max_str_len=3, max_alloc=32)
+        self.assertEqual(unpack(b"\x92\xa3abc\x91\x01"), ([u"abc", [1]], 7))
+        # the allocation budget is per message
+        self.assertEqual(unpack(b"\x92\xa3abc\x91\x01"), ([u"abc", [1]], 7))
+
+    def test_session_limits(self):
+        session = mpack.Session(max_alloc=6)
+        self.assertEqual(session.receive(b"\x93\x02\xa3abc\xa3def"),
+                         (10, 'notification', u"abc", u"def", None))
+        with self.assertRaises(mpack.MpackLimitException):
+            session.receive(b"\x93\x02\xa3abc\xa4defg")
+        with self.assertRaises(ValueError):
+            mpack.Session(unpacker=mpack.Unpacker(), max_depth=1)
+
 TestMpackRPC = statemachines.RPCSession.TestCase
 
 